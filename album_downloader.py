@@ -8,29 +8,68 @@ content while displaying download progress.
 import os
 import sys
 import re
-import json
-from concurrent.futures import ThreadPoolExecutor
+import html
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
-import requests
-from bs4 import BeautifulSoup
 from rich.live import Live
 
+try:
+    # Optional: orjson parses the large preload payload noticeably faster.
+    import orjson as json
+except ImportError:
+    import json
+
 from helpers.general_utils import clear_terminal
+from helpers.pixiv_utils import construct_image_urls
 from helpers.progress_utils import create_progress_bar, create_progress_table
 from helpers.download_utils import (
-    save_image_from_response, save_gif_from_response, manage_running_tasks
+    SESSION, HOST_CONNECTION_LIMIT, save_image_from_response,
+    save_gif_from_response
 )
 
 SCRIPT_NAME = os.path.basename(__file__)
 DOWNLOAD_FOLDER = "Downloads"
 HOST_PAGE = "http://www.pixiv.net/"
 
-MAX_WORKERS = 10
+# Every image comes from the same host, whose concurrent downloads are
+# capped for the whole run, so more workers than that cap would only wait.
+MAX_WORKERS = HOST_CONNECTION_LIMIT
+ALBUM_WORKERS = 4
 TASK_COLOR = "light_cyan3"
 
+# Pixiv `illustType` values: illustrations and manga are downloaded as
+# images, ugoira as an animated GIF.
+IMAGE_ILLUST_TYPES = frozenset({0, 1})
+UGOIRA_ILLUST_TYPE = 2
+
 HEADERS = {'Referer': HOST_PAGE}
 TIMEOUT = 10
 
+# Directories already created during this run. Single-page artworks all share
+# the download folder, so this skips a redundant makedirs for most albums.
+CREATED_DIRECTORIES = set()
+
+# Shared by every album of a run, so worker threads (and the keep-alive
+# connections they use) are not torn down and recreated for each album.
+DOWNLOAD_EXECUTOR = ThreadPoolExecutor(
+    max_workers=MAX_WORKERS, thread_name_prefix='pixiv-download'
+)
+
+ARTWORK_ID_PATTERN = re.compile(r'artworks/(\d+)')
+
+# Only the preload meta tag is needed from the artwork page, so it is found
+# directly in the raw body instead of building a parse tree of the whole
+# document or decoding the whole page to text. The id is located with a plain
+# search and only the tag around it is parsed, so malformed markup elsewhere
+# in the page cannot make the matching backtrack.
+META_PRELOAD_ID = b'meta-preload-data'
+META_TAG_PATTERN = re.compile(
+    rb'<meta\b(?P<attributes>(?:[^>"\']|"[^"]*"|\'[^\']*\')*)>'
+)
+META_ATTRIBUTE_PATTERN = re.compile(
+    rb'([^\s=>"\'/]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>"\']*))'
+)
+
 class ArtworkDownloader:
     """
     A class used to download artwork from a given URL.
@@ -73,10 +112,10 @@ class ArtworkDownloader:
             bool: True if the artwork was successfully processed; 
                   False otherwise.
         """
-        user_illusts = illust_data['userIllusts']
+        user_illusts = illust_data.get('userIllusts')
 
-        if 'userIllusts' in illust_data and self.artwork_id in user_illusts:
-            self.artwork = illust_data['userIllusts'][self.artwork_id]
+        if user_illusts and self.artwork_id in user_illusts:
+            self.artwork = user_illusts[self.artwork_id]
             self.download_path = self.create_download_directory()
             self.handle_artwork_type()
             return True
@@ -118,7 +157,10 @@ class ArtworkDownloader:
         else:
             download_path = self.download_path
 
-        os.makedirs(download_path, exist_ok=True)
+        if download_path not in CREATED_DIRECTORIES:
+            os.makedirs(download_path, exist_ok=True)
+            CREATED_DIRECTORIES.add(download_path)
+
         return download_path
 
     def handle_artwork_type(self):
@@ -127,57 +169,153 @@ class ArtworkDownloader:
         and processing accordingly.
         """
         illust_type = self.artwork.get('illustType')
-        if illust_type in (0, 1):
+        if illust_type in IMAGE_ILLUST_TYPES:
             self.process_artwork_images()
 
-        elif illust_type == 2:
+        elif illust_type == UGOIRA_ILLUST_TYPE:
             self.process_artwork_gifs()
 
     def process_artwork_images(self):
         """
         Downloads individual images from the artwork and saves them in the
         specified directory.
+
+        Raises:
+            ValueError: If any image fails to download or is refused by the
+                        server.
         """
         images = self.artwork.get('pageCount', 1)
-        futures = {}
+        image_urls = construct_image_urls(self.artwork.get('url'), images)
+
+        # Every page shares the artwork ID and extension, so the filename
+        # prefix and suffix are computed once for the whole artwork.
+        filename_prefix = f"{self.artwork.get('id')}_p"
+        filename_suffix = f"_master1200{os.path.splitext(image_urls[0])[-1]}"
+
+        overall_task = self.overall_progress.add_task(
+            f"[{TASK_COLOR}]{self.artwork_id}", total=images, visible=True
+        )
+        futures = []
 
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            overall_task = self.overall_progress.add_task(
-                f"[{TASK_COLOR}]{self.artwork_id}", total=images, visible=True
+        for (image, image_url) in enumerate(image_urls):
+            task = self.job_progress.add_task(
+                f"[{TASK_COLOR}]Picture {image + 1}/{images}",
+                total=100, visible=False
             )
 
-            for image in range(images):
-                task = self.job_progress.add_task(
-                    f"[{TASK_COLOR}]Picture {image + 1}/{images}",
-                    total=100, visible=False
-                )
+            filename = f"{filename_prefix}{image}{filename_suffix}"
+            image_info = (image_url, filename)
+            task_info = (
+                self.job_progress, self.overall_progress,
+                task, overall_task
+            )
 
-                image_info = (self.artwork, image)
-                task_info = (
-                    self.job_progress, self.overall_progress,
-                    task, overall_task
-                )
+            future = DOWNLOAD_EXECUTOR.submit(
+                save_image_from_response,
+                image_info, self.download_path, task_info
+            )
+            futures.append(future)
 
-                future = executor.submit(
-                    save_image_from_response,
-                    image_info, self.download_path, task_info
-                )
-                futures[future] = task
-                manage_running_tasks(futures, self.job_progress)
+        # Every page is let finish, then the first failure is raised, so an
+        # album missing pages is not reported as downloaded.
+        wait(futures)
+        saved_pages = [future.result() for future in futures]
+
+        if not all(saved_pages):
+            raise ValueError(
+                f"{saved_pages.count(False)} page(s) of artwork "
+                f"{self.artwork_id} were refused by the server"
+            )
 
     def process_artwork_gifs(self):
         """
         Downloads the GIF of the artwork and saves it in the specified
         directory.
+
+        Raises:
+            ValueError: If the GIF fails to download or is refused by the
+                        server.
         """
         overall_task = self.overall_progress.add_task(
             f"[{TASK_COLOR}]{self.artwork_id}", total=1, visible=True
         )
-        save_gif_from_response(
+        saved = save_gif_from_response(
             self.artwork, self.download_path,
             (self.job_progress, self.overall_progress, 0, overall_task)
         )
 
+        if not saved:
+            raise ValueError(
+                f"The GIF of artwork {self.artwork_id} was refused by the "
+                "server"
+            )
+
+def parse_meta_attributes(attributes):
+    """
+    Parses the attributes of a meta tag into a mapping.
+
+    Args:
+        attributes (bytes): The raw attributes of the tag.
+
+    Returns:
+        dict: The value of each attribute, by lowercase name.
+    """
+    parsed_attributes = {}
+
+    for attribute in META_ATTRIBUTE_PATTERN.finditer(attributes):
+        (name, *values) = attribute.groups()
+        parsed_attributes[name.lower()] = next(
+            value for value in values if value is not None
+        )
+
+    return parsed_attributes
+
+def extract_preload_content(body):
+    """
+    Extracts the content of the preload meta tag from the raw page body,
+    whatever the order of its attributes.
+
+    Args:
+        body (bytes): The raw body of the artwork page.
+
+    Returns:
+        bytes: The HTML-escaped content of the tag, or None if the page has
+               no preload meta tag.
+    """
+    position = body.find(META_PRELOAD_ID)
+    previous_position = 0
+
+    while position != -1:
+        # Only the text since the previous occurrence is searched, so each
+        # part of the page is scanned once. When it holds no tag start, the
+        # enclosing tag was already tried for that occurrence and is skipped.
+        start = body.rfind(b'<meta', previous_position, position)
+        previous_position = position
+
+        # The id may also appear outside the tag, e.g. in a script, so the
+        # tag found before it must actually enclose it.
+        if start != -1:
+            tag_match = META_TAG_PATTERN.match(body, start)
+
+            # A tag that is never closed leaves the rest of the page
+            # malformed, so the search stops instead of rescanning it.
+            if not tag_match:
+                return None
+
+            if tag_match.end() > position:
+                attributes = parse_meta_attributes(
+                    tag_match.group('attributes')
+                )
+                if (
+                    attributes.get(b'id') == META_PRELOAD_ID
+                    and b'content' in attributes
+                ):
+                    return attributes[b'content']
+
+        position = body.find(META_PRELOAD_ID, position + len(META_PRELOAD_ID))
+
+    return None
+
 def fetch_artwork_data(url):
     """
     Fetches the artwork data by making an HTTP request to the provided URL
@@ -193,23 +331,24 @@ def fetch_artwork_data(url):
 
     Raises:
         TypeError: If the URL is not a string.
-        ValueError: If the artwork ID is not found in the URL.
+        ValueError: If the preload data is not found in the page or the
+                    artwork ID is not found in the URL.
     """
     if not isinstance(url, str):
         raise TypeError('The provided URL is not a string')
 
-    response = requests.get(url, headers=HEADERS, timeout=TIMEOUT)
+    response = SESSION.get(url, headers=HEADERS, timeout=TIMEOUT)
     if response.status_code != 200:
         response.raise_for_status()
 
-    soup = BeautifulSoup(response.content, 'html.parser')
+    preload_content = extract_preload_content(response.content)
+    if preload_content is None:
+        raise ValueError('No preload data found')
 
-    meta_content = soup.find(
-        'meta', {'id': 'meta-preload-data'}
-    ).get('content')
+    meta_content = html.unescape(preload_content.decode('utf-8'))
     data = json.loads(meta_content)
 
-    match = re.search(r'artworks/(\d+)', url)
+    match = ARTWORK_ID_PATTERN.search(url)
     if not match:
         raise ValueError('No artwork ID found')
 
@@ -237,6 +376,61 @@ def download_album(url, overall_progress, job_progress):
     )
     artwork_downloader.download()
 
+def download_albums(urls, overall_progress, job_progress):
+    """
+    Downloads the albums from the provided URLs, several at a time. Each
+    album fetches its metadata and queues its images independently, so the
+    round-trips of one album overlap the downloads of the others, while
+    the images of all albums still share the download workers.
+
+    Args:
+        urls (list of str): The URLs of the albums to download.
+        overall_progress (Progress): The overall progress tracker to show the
+                                     global download progress.
+        job_progress (Progress): The progress tracker to show the status of
+                                 individual downloads.
+
+    Yields:
+        str: The URL of each album, once it has been downloaded, in order of
+             completion.
+
+    Raises:
+        ValueError: If the album ID cannot be retrieved from a URL or if any
+                    issue occurs during the download.
+    """
+    executor = ThreadPoolExecutor(max_workers=ALBUM_WORKERS)
+    futures = {
+        executor.submit(
+            download_album, url, overall_progress, job_progress
+        ): url
+        for url in urls
+    }
+    pending = dict(futures)
+
+    try:
+        for future in as_completed(futures):
+            url = pending.pop(future)
+            future.result()
+            yield url
+
+    except Exception:
+        # Queued albums are dropped instead of being downloaded before the
+        # error surfaces. The albums already running are let finish, and
+        # reported when successful, so they are recorded before the error
+        # propagates.
+        executor.shutdown(wait=False, cancel_futures=True)
+        running = [future for future in pending if not future.cancelled()]
+        wait(running)
+
+        for future in running:
+            if future.exception() is None:
+                yield pending[future]
+        raise
+
+    finally:
+        # Also reached on interruption, so queued albums are never started.
+        executor.shutdown(wait=False, cancel_futures=True)
+
 def main():
     """
     The main entry point for the application.
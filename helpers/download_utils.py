@@ -1,22 +1,41 @@
 """
 This module provides functionality to download images and GIFs from Pixiv,
-along with progress tracking for downloads. It includes functions to handle 
-HTTP responses, save images, create GIFs from extracted frames, and display 
-download progress using the Rich library.
+along with progress tracking for downloads. It includes functions to handle
+HTTP responses, save images, create GIFs by decoding the frames of ugoira
+archives in memory, and display download progress using the Rich library.
 """
 
+import io
 import os
-import zipfile
 import shutil
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from functools import partial
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image
 
-from helpers.pixiv_utils import construct_image_url, construct_gif_url
+from helpers.pixiv_utils import construct_gif_url, construct_ugoira_meta_url
 
 HOST_PAGE = "http://www.pixiv.net/"
-CHUNK_SIZE = 16 * 1024
+CHUNK_SIZE = 64 * 1024
+PROGRESS_INTERVAL = 0.1
+WRITE_BUFFER_SIZE = 1024 * 1024
+PARTIAL_SUFFIX = '.part'
 TIMEOUT = 10
+POOL_SIZE = 16
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.3
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+HOST_CONNECTION_LIMIT = 4
+PALETTE_SAMPLE_SIZE = 64
+FRAME_EXTENSIONS = ('.jpg', '.png', '.jpeg')
+DEFAULT_FRAME_DELAY = 100
 
 ALT_HEADERS = {
     'User-Agent': (
@@ -32,39 +51,145 @@ ALT_HEADERS = {
     'Connection': 'keep-alive',
 }
 
+def create_session(pool_size=POOL_SIZE):
+    """
+    Creates an HTTP session whose connection pool is large enough to be
+    shared by all the download workers, so connections to Pixiv are kept
+    alive and reused instead of being opened for every request. Transient
+    connection failures and throttling responses are retried with backoff
+    on the pooled connections.
+
+    Args:
+        pool_size (int, optional): The maximum number of pooled connections
+                                   per host. Defaults to POOL_SIZE.
+
+    Returns:
+        requests.Session: The configured session.
+    """
+    session = requests.Session()
+    retries = Retry(
+        total=MAX_RETRIES, backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUS_CODES, raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size,
+        max_retries=retries
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+SESSION = create_session()
+
+# Caps the number of simultaneous downloads per host, so the workers back off
+# from Pixiv's image servers instead of getting throttled by them.
+HOST_SEMAPHORES = defaultdict(
+    lambda: threading.Semaphore(HOST_CONNECTION_LIMIT)
+)
+HOST_SEMAPHORES_LOCK = threading.Lock()
+
+def get_host_semaphore(url):
+    """
+    Retrieves the semaphore limiting concurrent downloads from the host of
+    the given URL, creating it on first use.
+
+    Args:
+        url (str): The URL about to be downloaded.
+
+    Returns:
+        threading.Semaphore: The semaphore shared by all downloads from the
+                             same host.
+    """
+    host = urlparse(url).netloc
+    with HOST_SEMAPHORES_LOCK:
+        return HOST_SEMAPHORES[host]
+
 def save_image_from_response(image_info, download_path, task_info):
     """
-    Saves the downloaded image to the specified directory.
+    Saves the downloaded image to the specified directory. Its progress bar
+    is shown once a connection slot to the host is held, so workers waiting
+    on the host limit do not leave empty bars on display.
 
     Args:
-        image_info (tuple): A tuple containing informations about the artwork.
+        image_info (tuple): A tuple containing the URL of the image and the
+                            filename to save it under.
         download_path (str): The directory where the image should be saved.
         task_info (tuple): A tuple containing informations about the current
                            task.
 
+    Returns:
+        bool: True if the image was saved or already present, False if the
+              server refused it.
+
     Raises:
         ValueError: If the response status code indicates a failure.
     """
-    (artwork, image) = image_info
+    (image_url, filename) = image_info
+    final_path = os.path.join(download_path, filename)
 
-    artwork_url = artwork.get('url')
-    image_url = construct_image_url(artwork_url, image)
+    if os.path.exists(final_path):
+        skip_download(task_info)
+        return True
 
-    response = requests.get(image_url, headers=ALT_HEADERS, timeout=TIMEOUT)
-    if response.status_code not in (200, 403):
-        raise ValueError(
-            "Unable to download image, server responded with "
-            f"status code: {response.status_code}"
-        )
+    (job_progress, _, task, _) = task_info
 
-    artwork_id = artwork.get('id')
-    file_extension = os.path.splitext(image_url)[-1]
-    formatted_filename = (
-        f"{artwork_id}_p{image}_master1200{file_extension}"
-    )
-    final_path = os.path.join(download_path, formatted_filename)
+    with get_host_semaphore(image_url):
+        job_progress.update(task, visible=True)
+
+        with SESSION.get(
+            image_url, headers=ALT_HEADERS, timeout=TIMEOUT, stream=True
+        ) as response:
+            # A refused page is skipped without reading its error body, so
+            # the worker moves on, and reported so the album is not recorded
+            # as downloaded while missing it.
+            if response.status_code == 403:
+                refuse_download(image_url, task_info)
+                return False
+
+            if response.status_code != 200:
+                raise ValueError(
+                    "Unable to download image, server responded with "
+                    f"status code: {response.status_code}"
+                )
 
-    download_with_progress(response, final_path, task_info)
+            download_with_progress(response, final_path, task_info)
+
+    return True
+
+def fetch_ugoira_frame_delays(artwork_id):
+    """
+    Fetches the delay of every frame of an ugoira from its metadata.
+
+    Args:
+        artwork_id (str): The ID of the artwork.
+
+    Returns:
+        dict: A mapping from frame filename to its delay in milliseconds.
+              Empty if the metadata cannot be retrieved, in which case the
+              default delay is used for every frame.
+    """
+    meta_url = construct_ugoira_meta_url(artwork_id)
+
+    try:
+        response = SESSION.get(meta_url, headers=ALT_HEADERS, timeout=TIMEOUT)
+        response.raise_for_status()
+        frames = response.json()['body']['frames']
+        frame_delays = {}
+
+        for frame in frames:
+            delay = frame.get('delay')
+            # Frames with an invalid delay are left out, so they fall back
+            # to the default delay instead of failing the whole GIF.
+            if isinstance(delay, int) and delay > 0:
+                frame_delays[frame.get('file')] = delay
+
+        return frame_delays
+
+    except (
+        requests.RequestException, ValueError, KeyError, TypeError,
+        AttributeError
+    ):
+        return {}
 
 def save_gif_from_response(artwork, download_path, task_info):
     """
@@ -76,91 +201,235 @@ def save_gif_from_response(artwork, download_path, task_info):
         task_info (tuple): A tuple containing informations about the current
                            task.
 
+    Returns:
+        bool: True if the GIF was saved or already present, False if the
+              server refused its archive.
+
     Raises:
         ValueError: If the response status code indicates a failure.
     """
-    def create_gif(extracted_folder, download_path, filename_gif):
+    def create_gif(zip_ref, download_path, filename_gif, frame_delays):
         """
-        Creates a GIF from the extracted frames and saves it.
+        Creates a GIF from the frames stored in the ugoira archive and saves
+        it. Frames are decoded straight from the archive, without being
+        extracted to disk first.
 
         Args:
-            extracted_folder (str): The folder containing the extracted
-                                    image frames.
+            zip_ref (ZipFile): The opened archive containing the image frames.
             download_path (str): The directory where the GIF should be saved.
             filename_gif (str): The name of the resulting GIF file.
-
-        Returns:
-            str: The path to the created GIF.
+            frame_delays (dict): The delay of each frame, by filename.
         """
-        image_files = sorted([
-            file for file in os.listdir(extracted_folder)
-            if file.endswith(('.jpg', '.png', '.jpeg'))
-        ])
+        image_files = sorted(
+            file for file in zip_ref.namelist()
+            if file.lower().endswith(FRAME_EXTENSIONS)
+        )
 
         images = [
-            Image.open(os.path.join(extracted_folder, image_file))
+            Image.open(io.BytesIO(zip_ref.read(image_file)))
             for image_file in image_files
         ]
 
-        gif_download_path = os.path.join(download_path, filename_gif)
-
-        images[0].save(
-            gif_download_path, save_all=True, append_images=images[1:],
-            loop=0, duration=100
+        # Quantize every frame against one shared palette, computed once from
+        # a strip of downscaled frames, so the GIF encoder does not have to
+        # build a palette for each frame.
+        frames = [image.convert('RGB') for image in images]
+        sample_sheet = Image.new(
+            'RGB', (PALETTE_SAMPLE_SIZE, PALETTE_SAMPLE_SIZE * len(frames))
         )
-
-    def extract_gif(artwork_id, zip_path, download_path):
-        extracted_folder = os.path.join(
-            download_path, f"{artwork_id}_extracted"
+        for index, frame in enumerate(frames):
+            sample_sheet.paste(
+                frame.resize((PALETTE_SAMPLE_SIZE, PALETTE_SAMPLE_SIZE)),
+                (0, index * PALETTE_SAMPLE_SIZE)
+            )
+
+        palette = sample_sheet.quantize(
+            colors=256, method=Image.Quantize.FASTOCTREE
         )
-        os.makedirs(extracted_folder, exist_ok=True)
+        frames = [
+            frame.quantize(palette=palette, dither=Image.Dither.NONE)
+            for frame in frames
+        ]
+
+        durations = [
+            frame_delays.get(image_file, DEFAULT_FRAME_DELAY)
+            for image_file in image_files
+        ]
+
+        gif_download_path = os.path.join(download_path, filename_gif)
+        partial_path = f"{gif_download_path}{PARTIAL_SUFFIX}"
 
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(extracted_folder)
+        try:
+            frames[0].save(
+                partial_path, format='GIF', save_all=True,
+                append_images=frames[1:], loop=0, duration=durations,
+                disposal=2, optimize=False
+            )
+            os.replace(partial_path, gif_download_path)
 
-        filename_gif = f"{artwork_id}.gif"
-        create_gif(extracted_folder, download_path, filename_gif)
+        except BaseException:
+            remove_partial_file(partial_path)
+            raise
 
-        os.remove(zip_path)
-        shutil.rmtree(extracted_folder)
+    def extract_gif(artwork_id, archive, download_path):
+        frame_delays = fetch_ugoira_frame_delays(artwork_id)
 
+        with zipfile.ZipFile(archive, 'r') as zip_ref:
+            filename_gif = f"{artwork_id}.gif"
+            create_gif(zip_ref, download_path, filename_gif, frame_delays)
+
+    (_, overall_progress, _, overall_task) = task_info
     artwork_url = artwork.get('url')
     gif_url = construct_gif_url(artwork_url)
-    response = requests.get(gif_url, headers=ALT_HEADERS, timeout=TIMEOUT)
+    artwork_id = artwork.get('id')
 
-    if response.status_code not in (200, 403):
-        raise ValueError(
-            "Unable to download image, server responded with "
-            f"status code: {response.status_code}"
-        )
+    if os.path.exists(os.path.join(download_path, f"{artwork_id}.gif")):
+        skip_download(task_info, is_gif=True)
+        return True
 
-    artwork_id = artwork.get('id')
-    formatted_filename = f"{artwork_id}.zip"
-    zip_path = os.path.join(download_path, formatted_filename)
+    # The archive is only an intermediate step towards the GIF, so it is
+    # kept in memory instead of being written to disk and read back.
+    with get_host_semaphore(gif_url), SESSION.get(
+        gif_url, headers=ALT_HEADERS, timeout=TIMEOUT, stream=True
+    ) as response:
+        if response.status_code == 403:
+            refuse_download(gif_url, task_info, is_gif=True)
+            return False
 
-    download_with_progress(response, zip_path, task_info, is_gif=True)
-    extract_gif(artwork_id, zip_path, download_path)
+        if response.status_code != 200:
+            raise ValueError(
+                "Unable to download image, server responded with "
+                f"status code: {response.status_code}"
+            )
+
+        archive = io.BytesIO(response.content)
+
+    extract_gif(artwork_id, archive, download_path)
+    overall_progress.advance(overall_task)
+    return True
 
-def manage_running_tasks(futures, job_progress):
+class ProgressReader:
     """
-    Manages and updates the status of running tasks in a concurrent 
-    execution environment.
+    A file-like wrapper around a raw response stream that reports the
+    download percentage as it is read, so the stream can be copied with
+    `shutil.copyfileobj` instead of a Python-level chunk loop. Progress is
+    reported at most once every PROGRESS_INTERVAL seconds, which matches
+    the refresh rate of the live display, so the progress bar lock is not
+    taken for every chunk.
+
+    Attributes:
+        raw (file-like): The underlying stream to read from.
+        file_size (int): The expected size of the content, or -1 if unknown.
+        on_progress (callable): Called with the `completed` percentage as a
+                                keyword argument, or None to skip reporting.
+        total_downloaded (int): The number of bytes read so far.
+        last_report (float): The monotonic time progress was last reported.
+    """
+
+    def __init__(self, raw, file_size, on_progress=None):
+        self.raw = raw
+        self.file_size = file_size
+        self.on_progress = on_progress
+        self.total_downloaded = 0
+        self.last_report = time.monotonic()
+
+    def read(self, size=-1):
+        """
+        Reads up to `size` bytes from the stream and reports the progress
+        when enough time has passed since the last report.
+
+        Args:
+            size (int, optional): The maximum number of bytes to read.
+
+        Returns:
+            bytes: The data read, or an empty bytes object at end of stream.
+        """
+        chunk = self.raw.read(size)
+        self.total_downloaded += len(chunk)
+
+        if not self.on_progress or self.file_size <= 0:
+            return chunk
+
+        now = time.monotonic()
+        if now - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = now
+            self.on_progress(
+                completed=(self.total_downloaded / self.file_size) * 100
+            )
+
+        return chunk
+
+def skip_download(task_info, is_gif=False):
+    """
+    Marks a download as complete without fetching it, for files that were
+    already saved by a previous run.
 
     Args:
-        futures (dict): A dictionary mapping futures to their
-                        corresponding tasks. Each future represents 
-                        an asynchronous task.
-        job_progress (Progress): An instance of a progress tracking 
-                                 object used to manage and update 
-                                 task visibility.
+        task_info (tuple): A tuple containing progress-related information,
+                           as described in `download_with_progress`.
+        is_gif (bool, optional): If True, the task has no individual
+                                 progress bar to hide. Default is False.
     """
-    while futures:
-        for future in list(futures.keys()):
-            if future.running():
-                task = futures.pop(future)
-                job_progress.update(task, visible=True)
+    (job_progress, overall_progress, task, overall_task) = task_info
 
-def download_with_progress(response, download_path, task_info, is_gif=False):
+    if not is_gif:
+        job_progress.update(task, completed=100, visible=False)
+    overall_progress.advance(overall_task)
+
+def refuse_download(url, task_info, is_gif=False):
+    """
+    Reports a download the server refused, typically because of throttling.
+    Its progress bar is hidden without being marked as complete, so the
+    album is not counted as fully downloaded.
+
+    Args:
+        url (str): The URL that was refused.
+        task_info (tuple): A tuple containing progress-related information,
+                           as described in `download_with_progress`.
+        is_gif (bool, optional): If True, the task has no individual
+                                 progress bar to hide. Default is False.
+    """
+    (job_progress, _, task, _) = task_info
+    print(f"Skipped {url}: the server refused it with status code 403")
+
+    if not is_gif:
+        job_progress.update(task, visible=False)
+
+def preallocate_file(file, file_size):
+    """
+    Reserves the expected size of a download on disk up front, so the
+    filesystem can allocate it in one go instead of growing the file on
+    every write. Silently does nothing where preallocation is unsupported.
+
+    Args:
+        file (file-like): The file opened for writing.
+        file_size (int): The expected size of the content, or -1 if unknown.
+    """
+    if file_size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return
+
+    try:
+        os.posix_fallocate(file.fileno(), 0, file_size)
+
+    except OSError:
+        pass
+
+def remove_partial_file(partial_path):
+    """
+    Removes the temporary file of a download that did not complete, so no
+    stale partial file is left in the download directory. Silently does
+    nothing if the file was never created.
+
+    Args:
+        partial_path (str): The path of the temporary file.
+    """
+    try:
+        os.remove(partial_path)
+
+    except OSError:
+        pass
+
+def download_with_progress(response, download_path, task_info):
     """
     Downloads content from a response object and displays a progress bar.
 
@@ -175,23 +444,32 @@ def download_with_progress(response, download_path, task_info, is_gif=False):
                         - task: The task associated with the current download.
                         - overall_task: The task tracking the overall download
                                         progress.
-        is_gif (bool, optional): If True, the content is a GIF and the function
-                                 will skip progress updates for individual file
-                                 chunks. Default is False.
     """
     (job_progress, overall_progress, task, overall_task) = task_info
     file_size = int(response.headers.get('content-length', -1))
-    total_downloaded = 0
 
-    with open(download_path, 'wb') as file:
-        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-            if chunk:
-                file.write(chunk)
-                total_downloaded += len(chunk)
-                progress_percentage = (total_downloaded / file_size) * 100
-                if not is_gif:
-                    job_progress.update(task, completed=progress_percentage)
-
-    if not is_gif:
-        job_progress.update(task, completed=100, visible=False)
+    # Let urllib3 undo any transfer encoding while the raw stream is copied.
+    response.raw.decode_content = True
+    on_progress = partial(job_progress.update, task)
+    reader = ProgressReader(response.raw, file_size, on_progress)
+
+    # The content is written under a temporary name and only moved into
+    # place once complete, so an existing file is always a finished one.
+    # The write buffer is larger than a chunk, so several chunks are
+    # coalesced into a single write to disk.
+    partial_path = f"{download_path}{PARTIAL_SUFFIX}"
+    try:
+        with open(partial_path, 'wb', buffering=WRITE_BUFFER_SIZE) as file:
+            preallocate_file(file, file_size)
+            shutil.copyfileobj(reader, file, length=CHUNK_SIZE)
+            # Drops any preallocated space the content did not fill.
+            file.truncate()
+
+        os.replace(partial_path, download_path)
+
+    except BaseException:
+        remove_partial_file(partial_path)
+        raise
+
+    job_progress.update(task, completed=100, visible=False)
     overall_progress.advance(overall_task)
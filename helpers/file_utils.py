@@ -1,12 +1,17 @@
 """
 This module provides utility functions for file input and output operations. It 
-includes methods to read the contents of a file and to write content to a file, 
-with optional support for clearing the file.
+includes methods to read the lines of a file and to append lines to a file
+that is already open.
 """
 
+READ_BUFFER_SIZE = 64 * 1024
+
 def read_file(filename):
     """
-    Reads the contents of a file and returns a list of its lines.
+    Reads the contents of a file and returns a list of its lines. The file
+    is iterated line by line, so its whole contents are never held in
+    memory alongside the split lines, through a buffer large enough to read
+    typical URL lists in a single call.
 
     Args:
         filename (str): The path to the file to be read.
@@ -14,22 +19,21 @@ def read_file(filename):
     Returns:
         list: A list of lines from the file, with newline characters removed.
     """
-    with open(filename, 'r', encoding='utf-8') as file:
-        return file.read().splitlines()
+    with open(
+        filename, 'r', encoding='utf-8', buffering=READ_BUFFER_SIZE
+    ) as file:
+        return [line.rstrip('\n') for line in file]
 
-def write_file(filename, content='', mode='w'):
+def append_line(file, line):
     """
-    Writes or appends content to a specified file.
+    Appends a line to a file that is already open, so repeated appends
+    reuse one handle and its buffer instead of reopening the file.
 
     Args:
-        filename (str): The path to the file to be written to.
-        content (str, optional): The content to write to the file.
-                                 Defaults to an empty string.
-        mode (str, optional): The mode for file operation.
-                              'w' for overwrite (default) or 'a' for append.
+        file (TextIO): The file opened in append mode.
+        line (str): The line to append, without its newline character.
 
     Raises:
         IOError: If an error occurs while writing to the file.
     """
-    with open(filename, mode, encoding='utf-8') as file:
-        file.write(f"{content}\n" if mode == 'a' else content)
+    file.write(f"{line}\n")
@@ -4,27 +4,88 @@ images and GIFs associated with artworks on Pixiv. The URL construction
 is based on the artwork's base URL and the desired image page number.
 """
 
-import re
+THUMB_PREFIX = '/c/250x250_80_a2/'
+THUMB_DIRECTORIES = ('custom-thumb', 'img-master')
+THUMB_SUFFIXES = ('_square1200.jpg', '_custom1200.jpg')
+UGOIRA_META_URL = "https://www.pixiv.net/ajax/illust/{artwork_id}/ugoira_meta"
 
-def construct_image_url(artwork_url, image):
+def rewrite_thumbnail_url(artwork_url, path, suffix):
     """
-    Constructs the image URL for downloading based on the artwork URL and
-    page number.
+    Rewrites the thumbnail URL of an artwork by replacing its thumbnail path
+    and size suffix. Every rewrite is a fixed string, so plain string
+    operations are used instead of the regex engine, and both thumbnail
+    directories are handled by a single scan for their shared prefix.
 
     Args:
         artwork_url (str): The base URL of the artwork.
-        image (int): The page number of the image.
+        path (str): The path replacing the thumbnail path.
+        suffix (str): The suffix replacing the thumbnail size suffix.
 
     Returns:
-        str: The modified URL for downloading the specific image.
+        str: The rewritten URL.
     """
-    url = re.sub(r'/c/250x250_80_a2/custom-thumb', '/img-master', artwork_url)
-    url = re.sub(r'/c/250x250_80_a2/img-master', '/img-master', url)
-    url = re.sub(r'_square1200.jpg$', '_master1200.jpg', url)
-    url = re.sub(r'_custom1200.jpg$', '_master1200.jpg', url)
-    url = re.sub(r'p[0-9]+', f'p{image}', url)
+    url = artwork_url
+    (head, prefix, tail) = artwork_url.partition(THUMB_PREFIX)
+
+    if prefix:
+        (directory, separator, rest) = tail.partition('/')
+        if directory in THUMB_DIRECTORIES:
+            url = f"{head}{path}{separator}{rest}"
+
+    for thumb_suffix in THUMB_SUFFIXES:
+        if url.endswith(thumb_suffix):
+            return url[:-len(thumb_suffix)] + suffix
+
     return url
 
+def prepare_image_url_template(artwork_url):
+    """
+    Rewrites the artwork URL into a template for downloading its images,
+    with a `{page}` placeholder in place of the page number. The template
+    only depends on the artwork, so it can be built once and filled in for
+    every page.
+
+    Args:
+        artwork_url (str): The base URL of the artwork.
+
+    Returns:
+        str: The image URL template containing a `{page}` placeholder.
+    """
+    url = rewrite_thumbnail_url(artwork_url, '/img-master', '_master1200.jpg')
+
+    # Only the page token of the filename (e.g. `123_p0_master1200.jpg`) is
+    # replaced, so digits elsewhere in the URL are never touched.
+    (directory, separator, filename) = url.rpartition('/')
+    (artwork_id, page_separator, rest) = filename.partition('_p')
+    (page, suffix_separator, suffix) = rest.partition('_')
+
+    if not (page_separator and suffix_separator and page.isdigit()):
+        return url
+
+    return f"{directory}{separator}{artwork_id}_p{{page}}_{suffix}"
+
+def construct_image_urls(artwork_url, page_count):
+    """
+    Constructs the image URLs for downloading every page of the artwork.
+    The artwork URL is rewritten only once, and each page URL is then
+    assembled by concatenating the page number between the fixed prefix
+    and suffix of the template.
+
+    Args:
+        artwork_url (str): The base URL of the artwork.
+        page_count (int): The number of pages in the artwork.
+
+    Returns:
+        list: The URLs for downloading each image, in page order.
+    """
+    template = prepare_image_url_template(artwork_url)
+    (prefix, separator, suffix) = template.partition('{page}')
+
+    if not separator:
+        return [template] * page_count
+
+    return [f"{prefix}{page}{suffix}" for page in range(page_count)]
+
 def construct_gif_url(artwork_url):
     """
     Constructs the GIF URL for downloading based on the artwork URL.
@@ -35,10 +96,19 @@ def construct_gif_url(artwork_url):
     Returns:
         str: The modified URL for downloading the GIF.
     """
-    url = re.sub(
-        r'/c/250x250_80_a2/custom-thumb', '/img-zip-ugoira', artwork_url
+    return rewrite_thumbnail_url(
+        artwork_url, '/img-zip-ugoira', '_ugoira600x600.zip'
     )
-    url = re.sub(r'/c/250x250_80_a2/img-master', '/img-zip-ugoira', url)
-    url = re.sub(r'_square1200.jpg$', '_ugoira600x600.zip', url)
-    url = re.sub(r'_custom1200.jpg$', '_ugoira600x600.zip', url)
-    return url
+
+def construct_ugoira_meta_url(artwork_id):
+    """
+    Constructs the URL of the ugoira metadata, which lists the frames of
+    an animated artwork along with their delays.
+
+    Args:
+        artwork_id (str): The ID of the artwork.
+
+    Returns:
+        str: The URL for fetching the ugoira metadata.
+    """
+    return UGOIRA_META_URL.format(artwork_id=artwork_id)
@@ -7,12 +7,12 @@ import os
 from rich.live import Live
 from rich.table import Table
 
-from helpers.file_utils import read_file, write_file
+from helpers.file_utils import read_file, append_line
 from helpers.general_utils import clear_terminal
 from helpers.progress_utils import (
     create_progress_bar, create_progress_table, create_log_table
 )
-from album_downloader import download_album
+from album_downloader import download_albums
 
 FILE = 'URLs.txt'
 ALREADY_DOWNLOADED = 'already_downloaded.txt'
@@ -44,28 +44,37 @@ def process_urls(urls):
     Args:
         urls (list of str): A list of URLs to process for album downloads.
     """
-    if not os.path.exists(ALREADY_DOWNLOADED):
-        write_file(ALREADY_DOWNLOADED)
+    # A single append handle is kept open for the whole run, so recording
+    # each album does not reopen the history file; it is flushed on close,
+    # even when the downloads are interrupted. Opening it also creates the
+    # history file on the first run, before it is read.
+    with open(
+        ALREADY_DOWNLOADED, 'a', encoding='utf-8'
+    ) as already_downloaded_file:
+        already_downloaded_albums = set(read_file(ALREADY_DOWNLOADED))
+        log_messages = []
 
-    already_downloaded_albums = set(read_file(ALREADY_DOWNLOADED))
-    log_messages = []
+        overall_progress = create_progress_bar()
+        job_progress = create_progress_bar()
+        progress_table = create_progress_table(overall_progress, job_progress)
 
-    overall_progress = create_progress_bar()
-    job_progress = create_progress_bar()
-    progress_table = create_progress_table(overall_progress, job_progress)
+        urls_to_download = []
+        # Duplicated lines are only processed once, keeping their order.
+        for url in dict.fromkeys(urls):
+            # The set lookup is cheaper than the substring scan, and most
+            # URLs of a re-run are already downloaded, so it is done first.
+            if url in already_downloaded_albums:
+                log_messages.append(url)
+            elif HOST_BASE_LINK in url:
+                urls_to_download.append(url)
 
-    with Live(progress_table, refresh_per_second=10) as live:
-        for url in urls:
-            if HOST_BASE_LINK in url:
-                to_download = url not in already_downloaded_albums
+        with Live(progress_table, refresh_per_second=10) as live:
+            for url in download_albums(
+                urls_to_download, overall_progress, job_progress
+            ):
+                append_line(already_downloaded_file, url)
 
-                if to_download:
-                    download_album(url, overall_progress, job_progress)
-                    write_file(ALREADY_DOWNLOADED, url, mode='a')
-                else:
-                    log_messages.append(url)
-
-        manage_combined_table(live, progress_table, log_messages)
+            manage_combined_table(live, progress_table, log_messages)
 
 def main():
     """
@@ -74,7 +83,7 @@ def main():
     clear_terminal()
     urls = read_file(FILE)
     process_urls(urls)
-    write_file(FILE)
+    os.truncate(FILE, 0)
 
 if __name__ == '__main__':
     main()